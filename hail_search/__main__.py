@@ -15,4 +15,6 @@ def run():
     )
 
 
-run()
+# Query worker processes are spawned, and so re-import the main module
+if __name__ == '__main__':
+    run()
@@ -1107,13 +1107,12 @@ class BaseHailTableQuery(object):
     def _comp_het_entry_has_ref(self, gt1, gt2):
         return [self.GENOTYPE_QUERY_MAP[REF_REF](gt1), self.GENOTYPE_QUERY_MAP[REF_REF](gt2)]
 
-    def _format_comp_het_results(self, ch_ht, annotation_fields):
+    def _format_comp_het_results(self, ch_row, annotation_fields):
         formatted_grouped_variants = hl.array([
-            self._format_results(ch_ht[GROUPED_VARIANTS_FIELD][0], annotation_fields=annotation_fields),
-            self._format_results(ch_ht[GROUPED_VARIANTS_FIELD][1], annotation_fields=annotation_fields),
+            self._format_results(ch_row[GROUPED_VARIANTS_FIELD][0], annotation_fields=annotation_fields),
+            self._format_results(ch_row[GROUPED_VARIANTS_FIELD][1], annotation_fields=annotation_fields),
         ])
-        ch_ht = ch_ht.annotate(**{GROUPED_VARIANTS_FIELD: hl.sorted(formatted_grouped_variants, key=lambda x: x._sort)})
-        return ch_ht.annotate(_sort=ch_ht[GROUPED_VARIANTS_FIELD][0]._sort)
+        return hl.sorted(formatted_grouped_variants, key=lambda x: x._sort)
 
     def _format_results(self, ht, annotation_fields=None, **kwargs):
         if annotation_fields is None:
@@ -1126,14 +1125,20 @@ class BaseHailTableQuery(object):
         results = ht.annotate(**annotations)
         return results.select(*self.CORE_FIELDS, *list(annotations.keys()))
 
-    def format_search_ht(self):
+    def _result_sort(self, ht):
+        return self._format_results(ht, annotation_fields={})._sort
+
+    def format_search_sort_ht(self):
         ch_ht = None
-        annotation_fields = self.annotation_fields()
         if self._comp_het_ht:
-            ch_ht = self._format_comp_het_results(self._comp_het_ht, annotation_fields)
+            ch_ht = self._comp_het_ht.annotate(_sort=hl.sorted([
+                self._result_sort(self._comp_het_ht[GROUPED_VARIANTS_FIELD][0]),
+                self._result_sort(self._comp_het_ht[GROUPED_VARIANTS_FIELD][1]),
+            ])[0])
 
         if self._ht:
-            ht = self._format_results(self._ht.key_by(), annotation_fields=annotation_fields)
+            ht = self._ht.key_by()
+            ht = ht.annotate(_sort=self._result_sort(ht))
             if ch_ht:
                 ht = ht.union(ch_ht, unify=True)
         else:
@@ -1141,17 +1146,43 @@ class BaseHailTableQuery(object):
         return ht
 
     def search(self):
-        ht = self.format_search_ht()
+        # Searches are run in two phases: the top results are selected using only their sort order, and then the full
+        # annotations are only computed for the returned results, as formatting every matched row is expensive
+        ht = self.format_search_sort_ht()
 
         (total_results, collected) = ht.aggregate((hl.agg.count(), hl.agg.take(ht.row, self._num_results, ordering=ht._sort)))
         logger.info(f'Total hits: {total_results}. Fetched: {self._num_results}')
 
-        return self._format_collected_rows(collected), total_results
+        return self._format_collected_rows(collected, ht.row.dtype), total_results
 
-    def _format_collected_rows(self, collected):
-        if self._has_comp_het_search:
-            return [row.get(GROUPED_VARIANTS_FIELD) or row.drop(GROUPED_VARIANTS_FIELD) for row in collected]
-        return collected
+    def _format_collected_rows(self, collected, row_type, format_variant=None):
+        annotation_fields = self.annotation_fields()
+
+        def _format_variant(r):
+            formatted = self._format_results(r, annotation_fields=annotation_fields)
+            return format_variant(formatted) if format_variant else formatted
+
+        def _format_rows(is_comp_het, rows):
+            format_row = (lambda r: self._format_comp_het_results(r, annotation_fields)) if is_comp_het else _format_variant
+            return self._eval_formatted_rows(rows, row_type, format_row)
+
+        return self._format_grouped_rows(collected, lambda row: bool(row.get(GROUPED_VARIANTS_FIELD)), _format_rows)
+
+    @staticmethod
+    def _format_grouped_rows(rows, get_group, format_rows):
+        row_indices = defaultdict(list)
+        for i, row in enumerate(rows):
+            row_indices[get_group(row)].append(i)
+
+        formatted = [None] * len(rows)
+        for group, indices in row_indices.items():
+            for i, row in zip(indices, format_rows(group, [rows[i] for i in indices])):
+                formatted[i] = row
+        return formatted
+
+    @staticmethod
+    def _eval_formatted_rows(rows, row_type, format_row):
+        return hl.eval(hl.literal(rows, hl.tarray(row_type)).map(format_row))
 
     def _sort_order(self, ht):
         sort_expressions = self._get_sort_expressions(ht, XPOS)
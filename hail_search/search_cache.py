@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+
+from hail_search.queries.multi_data_types import QUERY_CLASS_MAP
+
+SEARCH_CACHE_MAX_MB = int(os.environ.get('HAIL_SEARCH_CACHE_MAX_MB', 256))
+
+
+def _json_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def _table_version(table_path):
+    # Tables are only considered complete once hail has written their _SUCCESS file, so its modification time changes
+    # every time new data is written. Tables not on a locally mounted file system are versioned via reload_globals only
+    try:
+        return os.path.getmtime(os.path.join(table_path, '_SUCCESS'))
+    except OSError:
+        return None
+
+
+class SearchResultCache(object):
+    """
+    Caches serialized search responses, keyed by the canonicalized request body and the version of the data the
+    search reads, i.e. the globals of the loaded annotation tables and the on-disk versions of the searched project
+    tables. Entries are evicted in least recently used order once the total cached response size exceeds the max size
+    """
+
+    def __init__(self, max_size_mb=SEARCH_CACHE_MAX_MB):
+        self._max_size = max_size_mb * (1024**2)
+        self._size = 0
+        self._results = OrderedDict()
+        self._globals_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def set_loaded_globals(self, loaded_globals):
+        globals_version = _json_hash({k: (v or {}).get('versions') for k, v in loaded_globals.items()})
+        if globals_version != self._globals_version:
+            self.clear()
+            self._globals_version = globals_version
+
+    def cache_key(self, path, request_body):
+        return _json_hash([path, request_body, self._globals_version, self._table_versions(request_body)])
+
+    @staticmethod
+    def _table_versions(request_body):
+        genome_version = request_body.get('genome_version')
+        table_versions = {}
+        for data_type, samples in (request_body.get('sample_data') or {}).items():
+            query_cls = QUERY_CLASS_MAP.get((data_type, genome_version))
+            if not query_cls:
+                continue
+            table_paths = {query_cls._get_table_path('annotations.ht')}
+            table_paths.update({
+                query_cls._get_table_path(f"projects/{s['sample_type']}/{s['project_guid']}.ht") for s in samples
+            })
+            table_versions.update({path: _table_version(path) for path in table_paths})
+        return table_versions
+
+    def get(self, key):
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._results.move_to_end(key)
+        return result
+
+    def set(self, key, result):
+        if len(result) > self._max_size:
+            return
+        if key in self._results:
+            self._size -= len(self._results.pop(key))
+        self._results[key] = result
+        self._size += len(result)
+        while self._size > self._max_size:
+            _, evicted = self._results.popitem(last=False)
+            self._size -= len(evicted)
+
+    def clear(self):
+        self._results = OrderedDict()
+        self._size = 0
+
+    def status(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._results),
+            'size_bytes': self._size,
+        }
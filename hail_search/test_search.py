@@ -17,7 +17,8 @@ from hail_search.test_utils import get_hail_search_body, FAMILY_2_VARIANT_SAMPLE
     VARIANT3_BOTH_SAMPLE_TYPES, VARIANT4_BOTH_SAMPLE_TYPES, VARIANT2_BOTH_SAMPLE_TYPES_PROBAND_WGS_ONLY, \
     VARIANT1_BOTH_SAMPLE_TYPES_PROBAND_WGS_ONLY, VARIANT3_BOTH_SAMPLE_TYPES_PROBAND_WGS_ONLY, \
     VARIANT4_BOTH_SAMPLE_TYPES_PROBAND_WGS_ONLY
-from hail_search.web_app import init_web_app, sync_to_async_hail_query
+from hail_search.search import load_globals
+from hail_search.web_app import init_web_app, sync_to_async_hail_query, HailQueryPool
 from hail_search.queries.base import BaseHailTableQuery
 
 PROJECT_2_VARIANT = {
@@ -222,23 +223,86 @@ class HailSearchTestCase(AioHTTPTestCase):
 
     async def test_sync_to_async_hail_query(self):
         request = mock.Mock()
-        request.app = await self.get_application()
+        request.app = self.app
         # NB: request.json() is the first arg passed to the callable
-        request.json.return_value = asyncio.Future()
-        request.json.return_value.set_result(3)
+        request.json = mock.AsyncMock(return_value=3)
+        worker_pids = self.app.pool.worker_pids
         with self.assertRaises(TimeoutError):
             await sync_to_async_hail_query(request, time.sleep, timeout_s=1)
 
-        with mock.patch('hail_search.web_app.ctypes.pythonapi.PyThreadState_SetAsyncExc') as mock_set_async_exc:
-            mock_set_async_exc.return_value = 2
-            with self.assertRaises(SystemExit):
-                await sync_to_async_hail_query(request, time.sleep, timeout_s=1)
+        # Timed out worker is terminated and replaced once the new worker has started
+        self.assertSetEqual(self.app.pool.worker_pids, set())
+        self.assertIsNone(await sync_to_async_hail_query(request, time.sleep, timeout_s=10))
+        self.assertEqual(len(self.app.pool.worker_pids), 1)
+        self.assertNotEqual(self.app.pool.worker_pids, worker_pids)
+
+        # Queries run concurrently in separate workers
+        pool = HailQueryPool(num_workers=2)
+        await pool.start()
+        try:
+            start = time.time()
+            await asyncio.gather(pool.run(time.sleep, 3), pool.run(time.sleep, 3))
+            self.assertLess(time.time() - start, 6)
+        finally:
+            await pool.shutdown()
 
     async def test_status(self):
         async with self.client.request('GET', '/status') as resp:
             self.assertEqual(resp.status, 200)
             resp_json = await resp.json()
-        self.assertDictEqual(resp_json, {'success': True})
+        self.assertDictEqual(resp_json, {
+            'success': True, 'search_cache': {'hits': 0, 'misses': 0, 'entries': 0, 'size_bytes': 0},
+        })
+
+    async def test_search_cache(self):
+        search_body = get_hail_search_body(sample_data=FAMILY_2_VARIANT_SAMPLE_DATA)
+        async with self.client.request('POST', '/search', json=search_body) as resp:
+            self.assertEqual(resp.status, 200)
+            resp_json = await resp.json()
+        self.assertDictEqual(self.app.search_cache.status(), {
+            'hits': 0, 'misses': 1, 'entries': 1, 'size_bytes': mock.ANY,
+        })
+
+        # Equivalent request bodies are served from the cache, regardless of key order
+        reordered_search_body = dict(reversed(list(search_body.items())))
+        async with self.client.request('POST', '/search', json=reordered_search_body) as resp:
+            self.assertEqual(resp.status, 200)
+            self.assertDictEqual(await resp.json(), resp_json)
+        self.assertEqual(self.app.search_cache.hits, 1)
+
+        async with self.client.request('POST', '/search', json={**search_body, 'num_results': 1}) as resp:
+            self.assertEqual(resp.status, 200)
+            self.assertListEqual((await resp.json())['results'], resp_json['results'][:1])
+        self.assertEqual(self.app.search_cache.misses, 2)
+
+        # Gene counts are cached separately from search results
+        async with self.client.request('POST', '/gene_counts', json=search_body) as resp:
+            self.assertEqual(resp.status, 200)
+        self.assertEqual(self.app.search_cache.misses, 3)
+        self.assertEqual(self.app.search_cache.status()['entries'], 3)
+
+        # Updated project tables are not served from the cache
+        with mock.patch('hail_search.search_cache._table_version') as mock_table_version:
+            mock_table_version.return_value = 1
+            async with self.client.request('POST', '/search', json=search_body) as resp:
+                self.assertEqual(resp.status, 200)
+                self.assertDictEqual(await resp.json(), resp_json)
+        self.assertEqual(self.app.search_cache.misses, 4)
+
+        async with self.client.request('GET', '/status') as resp:
+            resp_json = await resp.json()
+        self.assertDictEqual(resp_json['search_cache'], {
+            'hits': 1, 'misses': 4, 'entries': 4, 'size_bytes': mock.ANY,
+        })
+
+        # Reloading unchanged globals does not clear the cache, but changed globals do
+        async with self.client.request('POST', '/reload_globals') as resp:
+            self.assertEqual(resp.status, 200)
+        self.assertEqual(self.app.search_cache.status()['entries'], 4)
+        self.app.search_cache.set_loaded_globals({"('SNV_INDEL', 'GRCh38')": {'versions': {'clinvar': '2024-01-01'}}})
+        self.assertDictEqual(self.app.search_cache.status(), {
+            'hits': 1, 'misses': 4, 'entries': 0, 'size_bytes': 0,
+        })
 
     async def test_reload_globals(self):
         async with self.client.request('POST', '/reload_globals') as resp:
@@ -246,6 +310,8 @@ class HailSearchTestCase(AioHTTPTestCase):
         self.assertTrue(
             resp_json["('SNV_INDEL', 'GRCh38')"]['versions']['gnomad_genomes'],
         )
+
+        # Globals are loaded in the query worker processes, so mocked globals can only be tested in process
         with mock.patch('hail_search.queries.base.hl.read_table') as mock_read_table:
             mock_read_table.return_value = hl.Table.parallelize(
                 [],
@@ -255,14 +321,12 @@ class HailSearchTestCase(AioHTTPTestCase):
                     versions=hl.Struct(reloaded_version=2),
                 )
             )
-            async with self.client.request('POST', '/reload_globals') as resp:
-                self.assertEqual(resp.status, 200)
-                resp_json = await resp.json()
+            reloaded_globals = load_globals()
         self.assertDictEqual(
-            resp_json["('SNV_INDEL', 'GRCh38')"],
+            reloaded_globals["('SNV_INDEL', 'GRCh38')"],
             {
-                'enums': {'reloaded_enum': 1},
-                'versions': {'reloaded_version': 2},
+                'enums': hl.Struct(reloaded_enum=1),
+                'versions': hl.Struct(reloaded_version=2),
             },
         )
 
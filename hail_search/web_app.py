@@ -1,9 +1,8 @@
 from aiohttp import web
 import asyncio
 import concurrent.futures
-import ctypes
-import functools
 import json
+import multiprocessing
 import os
 import hail as hl
 import logging
@@ -11,6 +10,7 @@ import traceback
 from typing import Callable
 
 from hail_search.search import search_hail_backend, load_globals, lookup_variant, lookup_variants
+from hail_search.search_cache import SearchResultCache
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +18,9 @@ JAVA_OPTS_XSS = os.environ.get('JAVA_OPTS_XSS')
 MACHINE_MEM = os.environ.get('MACHINE_MEM')
 JVM_MEMORY_FRACTION = 0.9
 QUERY_TIMEOUT_S = 300
+# Each query worker is a separate process with its own hail/ spark context, so memory is split evenly between workers
+QUERY_WORKERS = int(os.environ.get('HAIL_SEARCH_QUERY_WORKERS', 1))
+WORKER_SHUTDOWN_TIMEOUT_S = 10
 
 
 def _handle_exception(e, request):
@@ -46,81 +49,229 @@ def _hl_json_default(o):
 def hl_json_dumps(obj):
     return json.dumps(obj, default=_hl_json_default)
 
+
+def _init_hail(num_workers):
+    spark_conf = {}
+    # memory limits adapted from https://github.com/hail-is/hail/blob/main/hail/python/hailtop/hailctl/dataproc/start.py#L321C17-L321C36
+    if MACHINE_MEM:
+        driver_memory = int((int(MACHINE_MEM)-11)*JVM_MEMORY_FRACTION/num_workers)
+        spark_conf['spark.driver.memory'] = f'{max(driver_memory, 1)}g'
+    if JAVA_OPTS_XSS:
+        spark_conf.update({f'spark.{field}.extraJavaOptions': f'-Xss{JAVA_OPTS_XSS}' for field in ['driver', 'executor']})
+    hl.init(idempotent=True, spark_conf=spark_conf or None)
+    hl._set_flags(use_new_shuffle='1')
+
+
+def _run_query_worker(conn, num_workers):
+    # Runs in a dedicated worker process. Results are converted to plain json types before being sent back, so hail
+    # objects never need to be pickled, and errors are sent back rather than raised so the worker stays alive
+    logging.basicConfig(level=logging.INFO)
+    _init_hail(num_workers)
+    conn.send((json.loads(hl_json_dumps(load_globals())), None))
+    while True:
+        try:
+            query, request_body, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send((json.loads(hl_json_dumps(query(request_body, *args, **kwargs))), None))
+        except web.HTTPException as e:
+            conn.send((None, (type(e).__name__, e.reason)))
+        except Exception as e:
+            conn.send((None, (web.HTTPInternalServerError.__name__, f'{e}: {traceback.format_exc()}')))
+
+
+def _reload_globals(_):
+    return load_globals()
+
+
+def _hail_status(_):
+    return hl.eval(1 + 1)
+
+
+class HailQueryWorker(object):
+
+    def __init__(self, mp_context, num_workers):
+        self.conn, worker_conn = mp_context.Pipe()
+        self.process = mp_context.Process(target=_run_query_worker, args=(worker_conn, num_workers), daemon=True)
+        self.process.start()
+        worker_conn.close()
+        self.globals_version = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join(WORKER_SHUTDOWN_TIMEOUT_S)
+        self.conn.close()
+
+    def shutdown(self):
+        # Closing the connection lets the worker exit its query loop cleanly
+        self.conn.close()
+        self.process.join(WORKER_SHUTDOWN_TIMEOUT_S)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class HailQueryPool(object):
+    """
+    Runs hail queries in a pool of worker processes, each with its own hail backend, so that queries can run
+    concurrently without blocking the event loop. Unlike threads, a worker process running a query that exceeds the
+    timeout or is cancelled can be safely terminated, in which case a replacement worker is started in the background
+    and is only made available once it is fully initialized
+    """
+
+    def __init__(self, num_workers=QUERY_WORKERS):
+        self.num_workers = num_workers
+        self._mp_context = multiprocessing.get_context('spawn')
+        self._idle_workers = asyncio.Queue()
+        self._workers = set()
+        self._pending_workers = set()
+        # Threads are only used to wait on worker connections, at most one per started or running worker
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers * 2)
+        self._globals_version = 0
+        self.loaded_globals = None
+
+    async def start(self):
+        await asyncio.gather(*[self._start_worker() for _ in range(self.num_workers)])
+
+    @property
+    def worker_pids(self):
+        return {worker.pid for worker in self._workers}
+
+    async def _start_worker(self):
+        worker = HailQueryWorker(self._mp_context, self.num_workers)
+        self._workers.add(worker)
+        try:
+            self.loaded_globals = await self._receive(worker)
+        except BaseException:
+            self._workers.discard(worker)
+            await self._run_in_executor(worker.terminate)
+            raise
+        worker.globals_version = self._globals_version
+        self._idle_workers.put_nowait(worker)
+
+    def _replace_worker(self, worker):
+        self._workers.discard(worker)
+        task = asyncio.ensure_future(self._terminate_and_replace_worker(worker))
+        self._pending_workers.add(task)
+        task.add_done_callback(self._pending_workers.discard)
+
+    async def _terminate_and_replace_worker(self, worker):
+        await self._run_in_executor(worker.terminate)
+        try:
+            await self._start_worker()
+        except Exception as e:
+            logger.error(f'Unable to start replacement hail query worker: {e}')
+
+    async def _run_in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _receive(self, worker):
+        result, error = await self._run_in_executor(worker.conn.recv)
+        if error:
+            error_cls, reason = error
+            raise getattr(web, error_cls)(reason=reason)
+        return result
+
+    async def _run_on_worker(self, worker, query, request_body, args, kwargs):
+        worker.conn.send((query, request_body, args, kwargs))
+        return await self._receive(worker)
+
+    async def run(self, query: Callable, request_body, *args, timeout_s=QUERY_TIMEOUT_S, reload_globals=False, **kwargs):
+        if reload_globals:
+            self._globals_version += 1
+        worker = await self._idle_workers.get()
+        try:
+            if worker.globals_version != self._globals_version and not reload_globals:
+                await asyncio.wait_for(self._run_on_worker(worker, _reload_globals, None, (), {}), timeout_s)
+            worker.globals_version = self._globals_version
+            result = await asyncio.wait_for(self._run_on_worker(worker, query, request_body, args, kwargs), timeout_s)
+            if reload_globals:
+                self.loaded_globals = result
+        except web.HTTPException:
+            self._idle_workers.put_nowait(worker)
+            raise
+        except asyncio.TimeoutError:
+            self._replace_worker(worker)
+            raise TimeoutError('Hail Query Timeout Exceeded')
+        except EOFError:
+            self._replace_worker(worker)
+            raise web.HTTPInternalServerError(reason='Hail query worker exited unexpectedly')
+        except BaseException:
+            # Includes cancelled requests and workers which have unexpectedly died
+            self._replace_worker(worker)
+            raise
+        self._idle_workers.put_nowait(worker)
+        return result
+
+    async def shutdown(self):
+        for task in list(self._pending_workers):
+            task.cancel()
+        await asyncio.gather(*self._pending_workers, return_exceptions=True)
+        await asyncio.gather(*[self._run_in_executor(worker.shutdown) for worker in self._workers])
+        self._workers = set()
+        self._executor.shutdown(wait=False)
+
+
 async def sync_to_async_hail_query(request: web.Request, query: Callable, *args, timeout_s=QUERY_TIMEOUT_S, **kwargs):
     request_body = None
     if request.body_exists:
         request_body = await request.json()
 
-    loop = asyncio.get_running_loop()
-    future = loop.run_in_executor(request.app.pool, functools.partial(query, request_body, *args, **kwargs))
-    try:
-        return await asyncio.wait_for(future, timeout_s)
-    except asyncio.TimeoutError:
-        # Well documented issue with the "wait_for" approach.... the concurrent.Future is canceled but
-        # the underlying thread is not, allowing the Hail Query under the hood to keep running.
-        # https://stackoverflow.com/questions/34452590/timeout-handling-while-using-run-in-executor-and-asyncio
-        # This unsafe approach is taken from:
-        # https://stackoverflow.com/questions/323972/is-there-any-way-to-kill-a-thread
-        #
-        # A few other thoughts:
-        # - A ProcessPoolExecutor instead of a ThreadPoolExecutor would allow for safe worker termination
-        # and would potentially be a safer option in general (some portion of a hail query is cpu bound in python!)
-        # - A "timeout" decorator applied to the query function, catching a SIGALARM would also potentially
-        # suffice... but threads don't play well with signals.
-        # - We could also just kill the service/pod (which is fine).
-        for t in request.app.pool._threads:
-            res = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(t.ident), ctypes.py_object(TimeoutError))
-            if res > 1:
-                # "if it returns a number greater than one, you're in trouble,
-                # and you should call it again with exc=NULL to revert the effect"
-                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(t.ident), None)
-                raise SystemExit('PyThreadState_SetAsyncExc failed')
-        raise TimeoutError('Hail Query Timeout Exceeded')
+    return await request.app.pool.run(query, request_body, *args, timeout_s=timeout_s, **kwargs)
+
+
+async def _cached_search_response(request: web.Request, format_response: Callable, **kwargs) -> web.Response:
+    cache_key = request.app.search_cache.cache_key(request.path, await request.json())
+    response_text = request.app.search_cache.get(cache_key)
+    if response_text is None:
+        hail_results = await sync_to_async_hail_query(request, search_hail_backend, **kwargs)
+        response_text = json.dumps(format_response(hail_results))
+        request.app.search_cache.set(cache_key, response_text)
+    return web.json_response(text=response_text)
+
 
 async def gene_counts(request: web.Request) -> web.Response:
-    hail_results = await sync_to_async_hail_query(request, search_hail_backend, gene_counts=True)
-    return web.json_response(hail_results, dumps=hl_json_dumps)
+    return await _cached_search_response(request, lambda hail_results: hail_results, gene_counts=True)
 
 
 async def search(request: web.Request) -> web.Response:
-    hail_results, total_results = await sync_to_async_hail_query(request, search_hail_backend)
-    return web.json_response({'results': hail_results, 'total': total_results}, dumps=hl_json_dumps)
+    return await _cached_search_response(
+        request, lambda hail_results: {'results': hail_results[0], 'total': hail_results[1]},
+    )
 
 
 async def lookup(request: web.Request) -> web.Response:
     result = await sync_to_async_hail_query(request, lookup_variant)
-    return web.json_response(result, dumps=hl_json_dumps)
+    return web.json_response(result)
 
 
 async def multi_lookup(request: web.Request) -> web.Response:
     result = await sync_to_async_hail_query(request, lookup_variants)
-    return web.json_response({'results': result}, dumps=hl_json_dumps)
+    return web.json_response({'results': result})
 
 
 async def reload_globals(request: web.Request) -> web.Response:
-    result = await sync_to_async_hail_query(request, lambda _: load_globals())
-    return web.json_response(
-        result,
-        dumps=hl_json_dumps
-    )
+    result = await sync_to_async_hail_query(request, _reload_globals, reload_globals=True)
+    # Cached results are invalidated if the reloaded data has changed
+    request.app.search_cache.set_loaded_globals(result)
+    return web.json_response(result)
 
 
 async def status(request: web.Request) -> web.Response:
-    # Make sure the hail backend process is still alive.
-    await sync_to_async_hail_query(request, lambda _: hl.eval(1 + 1))
-    return web.json_response({'success': True})
+    # Make sure the hail backend processes are still alive.
+    await sync_to_async_hail_query(request, _hail_status)
+    return web.json_response({'success': True, 'search_cache': request.app.search_cache.status()})
+
+
+async def _shutdown_query_pool(app):
+    await app.pool.shutdown()
 
 
 async def init_web_app():
-    spark_conf = {}
-    # memory limits adapted from https://github.com/hail-is/hail/blob/main/hail/python/hailtop/hailctl/dataproc/start.py#L321C17-L321C36
-    if MACHINE_MEM:
-        spark_conf['spark.driver.memory'] = f'{int((int(MACHINE_MEM)-11)*JVM_MEMORY_FRACTION)}g'
-    if JAVA_OPTS_XSS:
-        spark_conf.update({f'spark.{field}.extraJavaOptions': f'-Xss{JAVA_OPTS_XSS}' for field in ['driver', 'executor']})
-    hl.init(idempotent=True, spark_conf=spark_conf or None)
-    hl._set_flags(use_new_shuffle='1')
-    load_globals()
     app = web.Application(middlewares=[error_middleware], client_max_size=(1024**2)*10)
     app.add_routes([
         web.get('/status', status),
@@ -131,8 +282,12 @@ async def init_web_app():
         web.post('/multi_lookup', multi_lookup),
     ])
     # The idea here is to run the hail queries off the main thread so that the
-    # event loop stays live and the /status check is responsive.  We only
-    # run a single thread, though, so that hail queries block hail queries
-    # and we never run more than a single hail query at a time.
-    app.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    # event loop stays live and the /status check is responsive. Each worker
+    # process runs a single hail query at a time, so at most QUERY_WORKERS
+    # queries run concurrently and any additional queries wait for a free worker.
+    app.pool = HailQueryPool()
+    await app.pool.start()
+    app.on_cleanup.append(_shutdown_query_pool)
+    app.search_cache = SearchResultCache()
+    app.search_cache.set_loaded_globals(app.pool.loaded_globals)
     return app